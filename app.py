@@ -1,16 +1,27 @@
+import atexit
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, jsonify, Response
-from urllib.request import urlopen, Request
-from urllib.error import URLError, HTTPError
+import requests
+from requests.adapters import HTTPAdapter
+import socket
+import threading
 import time
+
+# orjson serializes the status payload several times faster than the
+# stdlib json used by jsonify; fall back cleanly when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from stream_mixer import StreamMixer
 from stream_proxy import stream_proxy
 from urllib.parse import urljoin, urlparse
 import flask
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -31,7 +42,28 @@ for i in range(len(DEFAULT_STREAM_URLS)):
         STREAM_URLS.append(env_url)
     else:
         STREAM_URLS.append(DEFAULT_STREAM_URLS[i])
-        logger.info(f"Using default stream URL for camera {i+1}: {DEFAULT_STREAM_URLS[i]}")
+        logger.info("Using default stream URL for camera %d: %s", i + 1, DEFAULT_STREAM_URLS[i])
+# Frozen after import: shared across threads, never mutated
+STREAM_URLS = tuple(STREAM_URLS)
+
+# Static part of each stream-status entry, built once; handlers only fill
+# in the status/error fields per request
+_STREAM_TEMPLATES = tuple(
+    {'id': i + 1, 'url': f"/proxy-stream/{i + 1}"}  # Proxied URLs for viewing
+    for i in range(len(STREAM_URLS))
+)
+
+# Shared executor so all stream probes run concurrently instead of serially
+status_executor = ThreadPoolExecutor(max_workers=min(32, len(STREAM_URLS)))
+atexit.register(status_executor.shutdown)
+
+# Pooled HTTP client so successive probes reuse TCP connections (keep-alive)
+status_session = requests.Session()
+status_session.headers.update({'User-Agent': 'OctoPrint-Stream-Viewer/1.0'})
+_status_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+status_session.mount('http://', _status_adapter)
+status_session.mount('https://', _status_adapter)
+atexit.register(status_session.close)
 
 def get_server_url():
     """Get the server's base URL"""
@@ -46,133 +78,303 @@ def get_server_url():
 
 # Initialize the stream mixer with full URLs (will be set in before_request)
 stream_mixer = None
+_mixer_init_lock = threading.Lock()
 
 @app.before_request
 def setup_stream_mixer():
     global stream_mixer
-    if stream_mixer is None:
+    if stream_mixer is not None:
+        return
+
+    # Double-checked init: concurrent first requests under a threaded WSGI
+    # server must not each spawn their own mixer and proxy threads
+    with _mixer_init_lock:
+        if stream_mixer is not None:
+            return
+
         # Initialize proxy streams first
         for i, url in enumerate(STREAM_URLS[:2], 1):  # Only first two streams for mixing
-            logger.info(f"Initializing proxy stream {i} with URL: {url}")
+            logger.info("Initializing proxy stream %d with URL: %s", i, url)
             try:
                 stream_proxy.ensure_stream_buffer(url, i)
             except Exception as e:
-                logger.error(f"Failed to initialize stream {i}: {str(e)}")
+                logger.error("Failed to initialize stream %d: %s", i, e)
 
         # Get base URL with correct protocol
         base_url = get_server_url()
-        logger.info(f"Using base URL for stream mixer: {base_url}")
+        logger.info("Using base URL for stream mixer: %s", base_url)
 
         # Create proxy URLs using same protocol as main app
         proxy_url1 = urljoin(base_url, f"/proxy-stream/1")
         proxy_url2 = urljoin(base_url, f"/proxy-stream/2")
-        logger.info(f"Proxy URLs: {proxy_url1}, {proxy_url2}")
+        logger.info("Proxy URLs: %s, %s", proxy_url1, proxy_url2)
 
         # Initialize mixer with 30-second interval and 3-second crossfade
-        stream_mixer = StreamMixer(proxy_url1, proxy_url2, transition_interval=30, transition_duration=3)
-        stream_mixer.start()
+        mixer = StreamMixer(proxy_url1, proxy_url2, transition_interval=30, transition_duration=3)
+        mixer.start()
+        # Publish only the fully-started mixer to other threads
+        stream_mixer = mixer
         logger.info("Stream mixer initialized and started")
 
+        # Start the status poller here rather than at import time: the
+        # first request only ever runs in the serving process, so the
+        # Werkzeug reloader parent never spawns a duplicate poller
+        _start_status_poller()
+
 @app.route('/proxy-stream/<int:stream_id>')
 def proxy_stream(stream_id):
     """Proxy the camera stream through a secure connection"""
     if 1 <= stream_id <= len(STREAM_URLS):
-        logger.debug(f"Proxying stream {stream_id} from URL: {STREAM_URLS[stream_id - 1]}")
+        logger.debug("Proxying stream %d from URL: %s", stream_id, STREAM_URLS[stream_id - 1])
         return stream_proxy.proxy_stream(STREAM_URLS[stream_id - 1], stream_id)
     return Response(status=404)
 
+# Status cache kept fresh by the background poller; the TTL only matters
+# as a fallback if the poller falls behind (e.g. probes running long)
+STATUS_CACHE_TTL = 10.0
+STATUS_POLL_INTERVAL = 3.0
+_status_cache = {}
+_status_cache_lock = threading.Lock()
+
 def check_stream_status(url):
-    """Check if a stream URL is accessible with retry logic"""
-    max_retries = 2
-    base_timeout = 5.0  # More lenient base timeout
+    """Check if a stream URL is accessible, using a short-TTL cache"""
+    now = time.monotonic()
+    with _status_cache_lock:
+        cached = _status_cache.get(url)
+        if cached is not None and now - cached[0] < STATUS_CACHE_TTL:
+            return cached[1]
 
-    for attempt in range(max_retries):
+    result = _probe_stream_status(url)
+
+    with _status_cache_lock:
+        _status_cache[url] = (time.monotonic(), result)
+    return result
+
+def _status_poller():
+    """Background loop refreshing the status cache so request handlers
+    read a recent result instead of waiting on a live probe"""
+    while True:
         try:
-            current_timeout = base_timeout * (attempt + 1)
-            logger.debug(f"Checking stream {url} (attempt {attempt + 1}/{max_retries}, timeout={current_timeout}s)")
+            results = list(status_executor.map(_probe_stream_status, STREAM_URLS))
+            now = time.monotonic()
+            with _status_cache_lock:
+                for url, result in zip(STREAM_URLS, results):
+                    _status_cache[url] = (now, result)
+        except Exception as e:
+            logger.error("Status poller error: %s", e)
+        time.sleep(STATUS_POLL_INTERVAL)
+
+_poller_thread = None
 
-            req = Request(
-                url,
-                headers={'User-Agent': 'OctoPrint-Stream-Viewer/1.0'}
-            )
+def _start_status_poller():
+    """Start the status poller once; callers hold _mixer_init_lock"""
+    global _poller_thread
+    if _poller_thread is None:
+        _poller_thread = threading.Thread(target=_status_poller, daemon=True)
+        _poller_thread.start()
 
-            response = urlopen(req, timeout=current_timeout)
+# Resolver cache: getaddrinfo can block for a long time on some systems
+# and camera hostnames don't change between probes
+DNS_CACHE_TTL = 60.0
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+
+def _resolve(host, port):
+    """Resolve host:port for a TCP probe, caching results for a minute"""
+    key = (host, port)
+    now = time.monotonic()
+    with _dns_cache_lock:
+        cached = _dns_cache.get(key)
+        if cached is not None and now - cached[0] < DNS_CACHE_TTL:
+            return cached[1]
+
+    addrinfos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+    with _dns_cache_lock:
+        _dns_cache[key] = (time.monotonic(), addrinfos)
+    return addrinfos
+
+# Set CAMERA_STATUS_HTTP_PROBE=1 to force full HTTP probes for endpoints
+# where TCP reachability alone is not a good enough health signal
+HTTP_PROBE = os.environ.get('CAMERA_STATUS_HTTP_PROBE') == '1'
+
+# Circuit breaker: after repeated failures, skip probing a URL for an
+# exponentially growing interval (capped at a minute) and report it down
+_breaker = {}  # url -> (consecutive_failures, open_until)
+_breaker_lock = threading.Lock()
+
+def _probe_stream_status(url):
+    """Probe a stream URL, skipping chronically-down URLs via a breaker"""
+    now = time.monotonic()
+    with _breaker_lock:
+        failures, open_until = _breaker.get(url, (0, 0.0))
+        if now < open_until:
+            return {
+                'status': False,
+                'error': 'Unreachable (probing suspended after repeated failures)'
+            }
+
+    if HTTP_PROBE:
+        result = _probe_stream_status_http(url)
+    else:
+        result = _probe_stream_status_tcp(url)
+
+    with _breaker_lock:
+        if result.get('status'):
+            _breaker.pop(url, None)
+        else:
+            # Clamp the exponent: the backoff saturates at the 60s cap
+            # anyway, and an unbounded 2.0 ** failures overflows once a
+            # URL has been down for long enough
+            failures = min(failures + 1, 6)
+            _breaker[url] = (failures, time.monotonic() + min(60.0, 2.0 ** failures))
+    return result
+
+def _probe_stream_status_tcp(url):
+    """Probe a stream URL for reachability.
+
+    MJPEG endpoints never finish their response, so a full GET just burns
+    the read timeout pulling frames. A plain TCP connect answers the only
+    question we ask here ("is the camera up?") for a single SYN/ACK.
+    """
+    parts = urlparse(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    try:
+        addrinfos = _resolve(parts.hostname, port)
+    except OSError as e:
+        logger.error("Error resolving stream host %s: %s", url, e)
+        return {
+            'status': False,
+            'error': str(e)
+        }
+
+    last_error = None
+    for family, socktype, proto, _, sockaddr in addrinfos:
+        try:
+            with socket.socket(family, socktype, proto) as sock:
+                sock.settimeout(2.0)
+                sock.connect(sockaddr)
             return {
                 'status': True,
                 'error': None
             }
-        except HTTPError as e:
-            logger.error(f"HTTP error checking stream {url}: {e.code} - {e.reason}")
+        except OSError as e:
+            last_error = e
+
+    logger.error("Error connecting to stream %s: %s", url, last_error)
+    return {
+        'status': False,
+        'error': str(last_error)
+    }
+
+def _probe_stream_status_http(url):
+    """Probe a stream URL with a full HTTP request and retry logic"""
+    max_retries = 2
+    # Separate connect/read timeouts: unreachable hosts fail after ~2s
+    # instead of eating the full read timeout on every probe
+    probe_timeout = (2.0, 5.0)
+
+    for attempt in range(max_retries):
+        try:
+            logger.debug("Checking stream %s (attempt %d/%d, timeout=%s)", url, attempt + 1, max_retries, probe_timeout)
+
+            # HEAD keeps the server from sending any body; fall back to a
+            # GET closed before the body is read when HEAD isn't allowed
+            response = status_session.head(url, timeout=probe_timeout,
+                                           allow_redirects=False)
+            if response.status_code == 405:
+                response = status_session.get(url, timeout=probe_timeout,
+                                              stream=True, allow_redirects=False)
+                response.close()
+
+            if response.status_code < 400:
+                return {
+                    'status': True,
+                    'error': None
+                }
+            logger.error("HTTP error checking stream %s: %s - %s", url, response.status_code, response.reason)
+            return {
+                'status': False,
+                'error': f"HTTP {response.status_code}: {response.reason}"
+            }
+        except requests.ConnectionError as e:
+            # Connection refused/unreachable will not recover within the
+            # retry window, so fail immediately
+            logger.error("Connection error checking stream %s: %s", url, e)
             return {
                 'status': False,
-                'error': f"HTTP {e.code}: {e.reason}"
+                'error': str(e)
             }
-        except URLError as e:
+        except requests.Timeout as e:
             if attempt < max_retries - 1:
                 time.sleep(1 * (attempt + 1))
                 continue
-            logger.error(f"Error checking stream {url} after {max_retries} attempts: {str(e)}")
+            logger.error("Error checking stream %s after %d attempts: %s", url, max_retries, e)
             return {
                 'status': False,
                 'error': str(e)
             }
         except Exception as e:
-            logger.error(f"Unexpected error checking stream {url}: {str(e)}")
+            logger.error("Unexpected error checking stream %s: %s", url, e)
             return {
                 'status': False,
                 'error': f"Unexpected error: {str(e)}"
             }
 
+
+# Constant multipart framing, built once; yielding it separately from the
+# frame lets the WSGI layer write the JPEG without copying it
+_FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+_FRAME_TRAILER = b'\r\n'
+
 def generate_mixed_frames():
     """Generator function for mixed stream frames"""
+    last_seq = 0
     while True:
-        frame = stream_mixer.get_latest_frame() if stream_mixer else None
+        if stream_mixer is None:
+            time.sleep(0.1)
+            continue
+        # Block until the mixer publishes a new frame instead of polling
+        frame, last_seq = stream_mixer.wait_for_frame(last_seq, timeout=1.0)
         if frame is not None:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        else:
-            time.sleep(0.033)  # Approximate 30 FPS
+            yield _FRAME_HEADER
+            yield frame
+            yield _FRAME_TRAILER
 
-@app.route('/')
-def index():
-    """Render the main page with stream views"""
-    # Get initial stream statuses
+def _collect_statuses():
+    """Build the stream-status entries shared by / and /check_streams"""
     stream_statuses = []
-    for i, url in enumerate(STREAM_URLS):
-        status_info = check_stream_status(url)
+    for template, status_info in zip(_STREAM_TEMPLATES,
+                                     status_executor.map(check_stream_status, STREAM_URLS)):
         if status_info is None:
             status_info = {'status': False, 'error': 'Failed to check stream status'}
         stream_statuses.append({
-            'id': i + 1,
-            'url': f"/proxy-stream/{i + 1}",  # Use proxied URLs for viewing
+            **template,
             'status': status_info.get('status', False),
             'error': status_info.get('error', 'Unknown error')
         })
+    return stream_statuses
 
-    return render_template('index.html', 
-                         streams=stream_statuses,
+@app.route('/')
+def index():
+    """Render the main page with stream views"""
+    return render_template('index.html',
+                         streams=_collect_statuses(),
                          STREAM_URLS=STREAM_URLS)  # Pass the actual URLs to template
 
 @app.route('/mixed-stream')
 def mixed_stream():
     """Stream the mixed video feed"""
     return Response(generate_mixed_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+                    mimetype='multipart/x-mixed-replace; boundary=frame',
+                    direct_passthrough=True)
 
 @app.route('/check_streams')
 def check_streams():
     """API endpoint to check stream statuses"""
-    stream_statuses = []
-    for i, url in enumerate(STREAM_URLS):
-        status_info = check_stream_status(url)
-        if status_info is None:
-            status_info = {'status': False, 'error': 'Failed to check stream status'}
-        stream_statuses.append({
-            'id': i + 1,
-            'url': f"/proxy-stream/{i + 1}",  # Use proxied URLs in status checks
-            'status': status_info.get('status', False),
-            'error': status_info.get('error', 'Unknown error')
-        })
+    stream_statuses = _collect_statuses()
+    if orjson is not None:
+        return Response(orjson.dumps(stream_statuses), mimetype='application/json')
     return jsonify(stream_statuses)
 
 # Error handlers
@@ -185,8 +387,6 @@ def internal_error(error):
     return render_template('index.html', error="Internal server error"), 500
 
 # Cleanup when the application exits
-import atexit
-
 @atexit.register
 def cleanup():
     if stream_mixer:
@@ -1,25 +1,116 @@
 import cv2
 import numpy as np
+import os
 import threading
 import time
-from queue import Queue
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from stream_proxy import stream_proxy
 
 logger = logging.getLogger(__name__)
 
+# Keep OpenCV's internal parallelism bounded: on a 4-core Pi the codec
+# and blend calls would otherwise spread across every core and fight the
+# decode pool and Flask's request threads for them. Two threads for
+# OpenCV leaves headroom for network I/O and the mixing loop itself.
+cv2.setUseOptimized(True)
+cv2.setNumThreads(int(os.environ.get('OPENCV_MIXER_THREADS', '2')))
+
+# Surface which SIMD paths this OpenCV build dispatches (NEON on Pi,
+# AVX2 on x86): stock wheels occasionally ship without them and the
+# blend/resize kernels then run several times slower with no other
+# symptom. One line at import makes that visible in the logs.
+try:
+    logger.info("OpenCV %s, CPU dispatch: %s", cv2.__version__,
+                cv2.getCPUFeaturesLine())
+except AttributeError:  # getCPUFeaturesLine needs OpenCV >= 4.1
+    logger.info("OpenCV %s (CPU feature info unavailable)", cv2.__version__)
+
+# libjpeg-turbo (via PyTurboJPEG) exposes the SIMD JPEG codec paths, which
+# are several times faster than OpenCV's bundled codecs on the Pi's ARM
+# cores; fall back to cv2.imdecode/imencode when it isn't installed
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+    _turbo_jpeg = TurboJPEG()
+except Exception:  # ImportError or missing native library
+    _turbo_jpeg = None
+
 class StreamMixer:
-    def __init__(self, url1, url2, transition_interval=30, transition_duration=3):
+    def __init__(self, url1, url2, transition_interval=30, transition_duration=3,
+                 jpeg_quality=75):
         self.url1 = url1
         self.url2 = url2
         self.transition_interval = transition_interval
         self.transition_duration = transition_duration
-        # Single small queue for output frames
-        self.frame_queue = Queue(maxsize=2)
+        # Q75 with 4:2:0 chroma subsampling roughly halves encode cost and
+        # frame size vs Q85 4:4:4 and is visually fine for camera streams
+        self.jpeg_quality = jpeg_quality
+        self._cv2_encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+            self._cv2_encode_params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                                        cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420]
+        # Single latest-frame slot: consumers block on the condition
+        # instead of polling, and the sequence number lets them skip
+        # frames they already yielded ("latest frame wins" semantics)
+        self.frame_ready = threading.Condition()
+        self.latest_frame = None
+        self._frame_seq = 0
+        # When consumers stop reading (stalled client, nobody connected)
+        # there is no point encoding frames that will just be overwritten
+        self._last_consumed = time.monotonic()
         self.running = False
+        # Interruptible sleeps: stop() sets this so the mixing thread
+        # wakes immediately instead of finishing its frame-rate nap
+        self._stop_event = threading.Event()
         self.current_stream = 1
-        self.last_transition = time.time()
+        self.last_transition = time.monotonic()
         self.target_size = None
+        # Reused crossfade output buffer, allocated once the frame size is
+        # known so the blend doesn't allocate a fresh frame 30x a second
+        self._blend_out = None
+        # A transition at 20 FPS only ever uses ~duration*20 distinct
+        # easing values, so precompute the cubic smoothstep curve once
+        steps = max(2, int(transition_duration * 20))
+        p = np.linspace(0.0, 1.0, steps)
+        self._ease_table = (p * p * (3.0 - 2.0 * p)).astype(np.float32)
+        # JPEG decode releases the GIL, so decoding both streams on two
+        # workers overlaps the transition's largest cost across cores
+        self._decode_pool = ThreadPoolExecutor(max_workers=2)
+        # Per-stream resize output buffers (one each so the parallel
+        # decodes never share a destination)
+        self._resize_bufs = {}
+        # Cached black frame used when one stream drops out mid-transition,
+        # so the fallback doesn't allocate a full frame every iteration
+        self._black = None
+        # Chosen scaled-decode factor per source frame size (None means
+        # decode at full resolution)
+        self._scale_factors = {}
+
+    def _pick_scaling_factor(self, src_w, src_h):
+        """Choose a libjpeg-turbo scaled-decode factor for a source size.
+
+        Picks the fraction yielding the smallest frame that still covers
+        target_size, so oversized sources shrink during the IDCT instead
+        of paying a full-resolution decode plus a separate resize pass.
+        Returns None when full-resolution decode is already right.
+        """
+        key = (src_w, src_h)
+        if key in self._scale_factors:
+            return self._scale_factors[key]
+        choice = None
+        if self.target_size is not None:
+            t_h, t_w = self.target_size
+            best_area = src_w * src_h
+            for num, den in getattr(_turbo_jpeg, 'scaling_factors', ()):
+                if num >= den:
+                    continue
+                s_w = (src_w * num + den - 1) // den
+                s_h = (src_h * num + den - 1) // den
+                if s_w >= t_w and s_h >= t_h and s_w * s_h < best_area:
+                    best_area = s_w * s_h
+                    choice = (num, den)
+        self._scale_factors[key] = choice
+        return choice
 
     def _get_frame(self, stream_id):
         """Get frame from stream without caching"""
@@ -29,8 +120,21 @@ class StreamMixer:
                 return None
 
             # Decode frame
-            nparr = np.frombuffer(frame_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            if _turbo_jpeg is not None:
+                scale = None
+                if self.target_size is not None:
+                    try:
+                        src_w, src_h = _turbo_jpeg.decode_header(frame_data)[:2]
+                        scale = self._pick_scaling_factor(src_w, src_h)
+                    except Exception:
+                        scale = None
+                if scale is not None:
+                    frame = _turbo_jpeg.decode(frame_data, scaling_factor=scale)
+                else:
+                    frame = _turbo_jpeg.decode(frame_data)  # BGR by default
+            else:
+                nparr = np.frombuffer(frame_data, np.uint8)
+                frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
             if frame is None:
                 return None
@@ -39,110 +143,213 @@ class StreamMixer:
             if self.target_size is None:
                 self.target_size = frame.shape[:2]
             elif frame.shape[:2] != self.target_size:
-                frame = cv2.resize(frame, (self.target_size[1], self.target_size[0]))
+                height, width = self.target_size
+                buf = self._resize_bufs.get(stream_id)
+                if buf is None or buf.shape[:2] != (height, width):
+                    buf = np.empty((height, width, 3), np.uint8)
+                    self._resize_bufs[stream_id] = buf
+                # INTER_AREA is the fast, high-quality choice for
+                # downscale; fixed-point INTER_LINEAR_EXACT for upscale
+                interpolation = (cv2.INTER_AREA if frame.shape[0] > height
+                                 else cv2.INTER_LINEAR_EXACT)
+                cv2.resize(frame, (width, height), dst=buf,
+                           interpolation=interpolation)
+                frame = buf
 
             return frame
 
         except Exception as e:
-            logger.error(f"Error processing frame from stream {stream_id}: {str(e)}")
+            logger.error("Error processing frame from stream %d: %s", stream_id, e)
             return None
 
     def _mix_streams(self):
         """Main mixing loop optimized for 20 FPS"""
         target_frame_time = 1.0 / 20.0  # Target 20 FPS
-        last_frame_time = time.time()
+        # Hoist invariant attribute lookups out of the per-frame loop
+        interval = self.transition_interval
+        duration = self.transition_duration
+        monotonic = time.monotonic
+        stop_wait = self._stop_event.wait
+        get_raw_frame = stream_proxy.get_frame
+        last_frame_time = monotonic()
 
         while self.running:
             try:
-                current_time = time.time()
+                current_time = monotonic()
                 frame_delta = current_time - last_frame_time
 
                 # Frame rate control
                 if frame_delta < target_frame_time:
-                    time.sleep(target_frame_time - frame_delta)
+                    if stop_wait(target_frame_time - frame_delta):
+                        break
                     continue
 
                 last_frame_time = current_time
 
-                # Get frames directly without caching
-                frame1 = self._get_frame(1)
-                frame2 = self._get_frame(2)
+                # Calculate transition state; once the window has fully
+                # elapsed, complete the flip and start a fresh cycle on
+                # the other stream
+                time_since_last = current_time - self.last_transition
+                if time_since_last >= interval + duration:
+                    self.current_stream = 3 - self.current_stream
+                    self.last_transition = current_time
+                    time_since_last = 0.0
+                in_transition = time_since_last >= interval
+
+                # Skip the encode when no consumer has asked for a frame
+                # recently; transitions still render so animation state
+                # stays correct
+                if (not in_transition
+                        and current_time - self._last_consumed > 0.2):
+                    continue
+
+                if not in_transition:
+                    # Keep the inactive stream's ingest warm: the next
+                    # crossfade needs it, and the proxy would otherwise
+                    # idle it out between transitions
+                    stream_proxy.keep_alive(3 - self.current_stream)
+                    # Steady state: the output is exactly the active
+                    # stream's frame, so forward its JPEG bytes untouched
+                    # instead of paying a decode + encode round trip
+                    raw = get_raw_frame(self.current_stream)
+                    if raw is not None:
+                        self._publish_frame(raw)
+                    else:
+                        # Nothing buffered yet: park on the proxy's
+                        # arrival condition instead of spinning on the
+                        # frame-pacing sleep
+                        stream_proxy.wait_for_frame_event(target_frame_time)
+                    continue
+
+                # Transition: decode both streams and crossfade
+                if self.target_size is None:
+                    # First decode learns target_size; run serially so the
+                    # two workers don't race to set it
+                    frame1 = self._get_frame(1)
+                    frame2 = self._get_frame(2)
+                else:
+                    future1 = self._decode_pool.submit(self._get_frame, 1)
+                    future2 = self._decode_pool.submit(self._get_frame, 2)
+                    frame1 = future1.result()
+                    frame2 = future2.result()
 
                 # Skip if no valid frames
                 if frame1 is None and frame2 is None:
                     continue
 
                 # Create blank frame if needed
-                if frame1 is None:
-                    frame1 = np.zeros_like(frame2)
-                if frame2 is None:
-                    frame2 = np.zeros_like(frame1)
+                if frame1 is None or frame2 is None:
+                    shape = (frame1 if frame1 is not None else frame2).shape
+                    if self._black is None or self._black.shape != shape:
+                        self._black = np.zeros(shape, np.uint8)
+                    if frame1 is None:
+                        frame1 = self._black
+                    else:
+                        frame2 = self._black
 
-                # Calculate transition state
-                time_since_last = current_time - self.last_transition
-                in_transition = (time_since_last >= self.transition_interval and 
-                               time_since_last < self.transition_interval + self.transition_duration)
-
-                # Generate output frame
-                if in_transition:
-                    # Calculate transition progress
-                    progress = (time_since_last - self.transition_interval) / self.transition_duration
-                    progress = min(1.0, max(0.0, progress))
-
-                    # Apply smooth easing function (cubic)
-                    t = progress * progress * (3 - 2 * progress)
-
-                    # Create crossfade
-                    alpha = t if self.current_stream == 2 else (1.0 - t)
-                    output_frame = cv2.addWeighted(frame1, 1.0 - alpha, frame2, alpha, 0)
-
-                    # Check for transition completion
-                    if progress >= 1.0:
-                        self.current_stream = 3 - self.current_stream
-                        self.last_transition = current_time
+                # Calculate transition progress
+                progress = (time_since_last - interval) / duration
+                progress = min(1.0, max(0.0, progress))
+
+                # Apply smooth easing function (cubic, via the precomputed table)
+                t = float(self._ease_table[int(progress * (len(self._ease_table) - 1))])
+
+                # Create crossfade: alpha is frame2's weight, so fading
+                # away from stream 1 ramps it 0 -> 1 and fading back
+                # runs 1 -> 0; either way the blend starts on the
+                # stream that was showing and ends on the other one
+                alpha = t if self.current_stream == 1 else (1.0 - t)
+                if alpha < 1.0 / 255.0:
+                    # Blend would be a no-op at 8-bit precision
+                    output_frame = frame1
+                elif alpha > 254.0 / 255.0:
+                    output_frame = frame2
                 else:
-                    # Normal playback
-                    output_frame = frame2 if self.current_stream == 2 else frame1
+                    if self._blend_out is None or self._blend_out.shape != frame1.shape:
+                        self._blend_out = np.empty_like(frame1)
+                    cv2.addWeighted(frame1, 1.0 - alpha, frame2, alpha, 0,
+                                    dst=self._blend_out)
+                    output_frame = self._blend_out
 
-                # Update frame queue
+                # Encode and publish the blended frame
                 if output_frame is not None:
-                    _, buffer = cv2.imencode('.jpg', output_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                    try:
-                        if not self.frame_queue.full():
-                            self.frame_queue.put_nowait(buffer.tobytes())
-                        else:
-                            # Clear old frame if queue is full
-                            try:
-                                self.frame_queue.get_nowait()
-                                self.frame_queue.put_nowait(buffer.tobytes())
-                            except:
-                                pass
-                    except Exception as e:
-                        logger.error(f"Failed to update frame queue: {str(e)}")
+                    if _turbo_jpeg is not None:
+                        frame_bytes = _turbo_jpeg.encode(output_frame,
+                                                         quality=self.jpeg_quality,
+                                                         jpeg_subsample=TJSAMP_420)
+                    else:
+                        _, buffer = cv2.imencode('.jpg', output_frame, self._cv2_encode_params)
+                        frame_bytes = buffer.tobytes()
+                    self._publish_frame(frame_bytes)
 
             except Exception as e:
-                logger.error(f"Error in stream mixing: {str(e)}")
-                time.sleep(target_frame_time)
+                logger.error("Error in stream mixing: %s", e)
+                if stop_wait(target_frame_time):
+                    break
+
+    def _publish_frame(self, frame_bytes):
+        """Hand an encoded JPEG frame to consumers (latest frame wins)"""
+        with self.frame_ready:
+            self.latest_frame = frame_bytes
+            self._frame_seq += 1
+            self.frame_ready.notify_all()
 
     def start(self):
         """Start the stream mixing process"""
         self.running = True
+        self._stop_event.clear()
         self.mixing_thread = threading.Thread(target=self._mix_streams)
         self.mixing_thread.daemon = True
         self.mixing_thread.start()
+        self._pin_mixing_thread()
+
+    def _pin_mixing_thread(self):
+        """Optionally pin the mixing thread to fixed cores.
+
+        Set MIXER_CPU_AFFINITY to a comma-separated core list (e.g.
+        "2,3") to stop the scheduler bouncing the hot loop between
+        cores and evicting its working set. Best effort: silently
+        skipped on platforms without sched_setaffinity or when the
+        thread id isn't available.
+        """
+        cores = os.environ.get('MIXER_CPU_AFFINITY')
+        if not cores or not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            cpu_set = {int(c) for c in cores.split(',')}
+            os.sched_setaffinity(self.mixing_thread.native_id, cpu_set)
+            logger.info("Pinned mixing thread to cores %s", sorted(cpu_set))
+        except (ValueError, OSError, AttributeError) as e:
+            logger.warning("Could not set mixing thread affinity: %s", e)
 
     def stop(self):
         """Stop the stream mixing process"""
         self.running = False
+        self._stop_event.set()
         if hasattr(self, 'mixing_thread'):
             self.mixing_thread.join()
+        self._decode_pool.shutdown(wait=False)
 
     def get_latest_frame(self):
         """Get the latest mixed frame"""
-        try:
-            return self.frame_queue.get_nowait()
-        except:
-            return None
+        self._last_consumed = time.monotonic()
+        return self.latest_frame
+
+    def wait_for_frame(self, last_seq, timeout=1.0):
+        """Block until a frame newer than last_seq is published.
+
+        Returns (frame_bytes, seq); frame_bytes is None on timeout so
+        callers can keep the connection alive without duplicate frames.
+        """
+        # Stamp on entry, not just on success: a waiting consumer is the
+        # demand signal that keeps the mixer producing
+        self._last_consumed = time.monotonic()
+        with self.frame_ready:
+            if self._frame_seq == last_seq:
+                self.frame_ready.wait(timeout)
+            if self._frame_seq == last_seq:
+                return None, last_seq
+            return self.latest_frame, self._frame_seq
 
     def __del__(self):
         self.stop()
\ No newline at end of file
@@ -1,34 +1,285 @@
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import cv2
 import numpy as np
-from flask import Response, stream_with_context
+from flask import Response, request, stream_with_context
 from urllib.parse import urlparse
 import time
-from queue import Queue
 import threading
 
 logger = logging.getLogger(__name__)
 
+# Multipart framing constants, yielded separately so each frame's JPEG
+# bytes go to the socket as-is instead of being copied into a new
+# header+frame+trailer buffer per yield
+_FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+_FRAME_TRAILER = b'\r\n'
+
+# SIMD JPEG encode for the VideoCapture re-encode path (same optional
+# dependency the mixer uses); cv2.imencode remains the fallback
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+    _turbo_jpeg = TurboJPEG()
+except Exception:  # ImportError or missing native library
+    _turbo_jpeg = None
+
 class StreamProxy:
     def __init__(self):
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'OctoPrint-Stream-Viewer/1.0'
         })
+        # Pooled adapter so content-type probes and stream reconnects
+        # reuse kept-alive TCP connections instead of re-handshaking
+        # (urllib3 already sets TCP_NODELAY on its sockets by default)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.stream_buffers = {}
-        self.frame_buffers = {}
-        self.buffer_locks = {}
+        # Latest-frame-wins slots: a single dict assignment/pop is
+        # atomic under the GIL, so no per-stream queue or lock is
+        # needed to keep only the newest frame
+        self.latest_frames = {}
         self.stream_threads = {}
+        # Per-stream stop signals so a buffer thread can be told to
+        # exit before a replacement is started
+        self.stop_events = {}
         self.video_captures = {}
+        # Signalled whenever any stream buffers a new frame, so waiters
+        # wake on arrival instead of sleeping a fixed interval
+        self.frame_available = threading.Condition()
+        # Last time get_frame was called per stream; ingest pauses when
+        # nothing has consumed a stream's frames for IDLE_TIMEOUT
+        self._last_consumed = {}
+        # Downscaled re-encodes for thumbnail viewers, keyed by
+        # (stream_id, width) and invalidated per source frame
+        self._resized_cache = {}
+
+    # URL fragments that identify sources serving multipart MJPEG
+    # directly (mjpg-streamer, motion, most IP camera snapshots)
+    MJPEG_URL_HINTS = ('action=stream', 'mjpg', 'mjpeg')
+
+    # Stop pulling from a camera when nothing has consumed its frames
+    # for this long; ingest resumes as soon as a consumer returns
+    IDLE_TIMEOUT = 10.0
+
+    # A single camera frame should never approach this; if the buffer
+    # does, the stream is corrupt and we resync rather than grow
+    # without bound
+    MAX_FRAME_BYTES = 4 * 1024 * 1024
+
+    # Target cadence for the VideoCapture re-encode path
+    FRAME_INTERVAL = 1.0 / 30.0
+
+    # ?w= requests snap to these widths so the resize cache stays
+    # bounded no matter what clients ask for
+    ALLOWED_WIDTHS = (160, 320, 480, 640, 960, 1280)
+
+    def _has_demand(self, stream_id):
+        """True while some consumer recently asked for this stream"""
+        last = self._last_consumed.get(stream_id, 0.0)
+        return time.monotonic() - last < self.IDLE_TIMEOUT
+
+    def _looks_like_mjpeg(self, stream_url):
+        """Heuristic: does this URL serve multipart MJPEG directly?"""
+        parsed = urlparse(stream_url)
+        if parsed.scheme not in ('http', 'https'):
+            return False
+        lowered = stream_url.lower()
+        return any(hint in lowered for hint in self.MJPEG_URL_HINTS)
+
+    def _probe_is_mjpeg(self, stream_url):
+        """Probe Content-Type to catch MJPEG servers the URL misses.
+
+        A cheap HEAD request at buffer startup; servers that reject
+        HEAD (some MJPEG daemons do) just fall through to the
+        VideoCapture path.
+        """
+        parsed = urlparse(stream_url)
+        if parsed.scheme not in ('http', 'https'):
+            return False
+        try:
+            response = self.session.head(stream_url, timeout=(2, 5),
+                                         allow_redirects=True)
+            content_type = response.headers.get('Content-Type', '')
+        except requests.RequestException:
+            return False
+        return content_type.startswith(('multipart/x-mixed-replace',
+                                        'image/jpeg'))
+
+    def _buffer_mjpeg_stream(self, stream_url, stream_id):
+        """Buffer JPEG frames straight from an MJPEG HTTP stream.
+
+        Holds one persistent connection per stream and slices complete
+        JPEGs out of the multipart body, so the camera's own encoded
+        frames reach the buffer without the decode + re-encode round
+        trip the VideoCapture path pays per frame, and without
+        reconnecting between frames.
+        """
+        stop = self.stop_events[stream_id]
+        while not stop.is_set():
+            try:
+                response = self.session.get(stream_url, stream=True,
+                                            timeout=(5, 30))
+                response.raise_for_status()
+                boundary = self._multipart_boundary(response)
+                logger.info("Connected to MJPEG stream %d (boundary=%s)",
+                            stream_id, boundary)
+                buf = bytearray()
+                scan = 0  # how far the EOI search has already looked
+                # Read the socket directly in large chunks: iter_content
+                # adds a Python generator frame and decode bookkeeping
+                # per chunk, and 64KB reads let the OS coalesce recv()s
+                # (~one syscall per frame instead of dozens)
+                raw = response.raw
+                # Belt and braces: make sure urllib3 never routes reads
+                # through its content-decoding layer
+                raw.decode_content = False
+                while not stop.is_set():
+                    if not self._has_demand(stream_id):
+                        logger.info("MJPEG stream %d idle, disconnecting",
+                                    stream_id)
+                        break
+                    chunk = raw.read(65536)
+                    if not chunk:
+                        break
+                    buf.extend(chunk)
+                    if len(buf) > self.MAX_FRAME_BYTES:
+                        logger.warning(
+                            "Stream %d buffered %d bytes without a frame "
+                            "boundary, resyncing", stream_id, len(buf))
+                        del buf[:]
+                        scan = 0
+                        continue
+                    while True:
+                        if boundary is not None:
+                            jpeg_frame = self._parse_multipart_frame(buf, boundary)
+                        else:
+                            jpeg_frame, scan = self._parse_eoi_frame(buf, scan)
+                        if jpeg_frame is None:
+                            break
+                        self.latest_frames[stream_id] = jpeg_frame
+                        with self.frame_available:
+                            self.frame_available.notify_all()
+                response.close()
+                # Don't reconnect until frames are wanted again
+                while not self._has_demand(stream_id):
+                    if stop.wait(0.5):
+                        return
+                logger.info("MJPEG stream %d reconnecting", stream_id)
+            except Exception as e:
+                logger.error("Error in MJPEG stream %d: %s", stream_id, e)
+                if stop.wait(1):
+                    return
+
+    @staticmethod
+    def _multipart_boundary(response):
+        """Extract the multipart boundary token from a stream response.
+
+        Returns the boundary as bytes (with the leading dashes) or None
+        when the server doesn't send a multipart Content-Type, in which
+        case the caller falls back to JPEG marker scanning.
+        """
+        content_type = response.headers.get('Content-Type', '')
+        if 'boundary=' not in content_type:
+            return None
+        token = content_type.split('boundary=')[-1].split(';')[0]
+        token = token.strip().strip('"')
+        if not token:
+            return None
+        boundary = token.encode('latin-1')
+        if not boundary.startswith(b'--'):
+            boundary = b'--' + boundary
+        return boundary
+
+    @staticmethod
+    def _parse_multipart_frame(buf, boundary):
+        """Slice one part payload out of a multipart buffer, or None.
+
+        When the part advertises Content-Length the payload is sliced
+        exactly, skipping the byte-wise marker scan entirely; otherwise
+        the payload runs to the next boundary.
+        """
+        start = buf.find(boundary)
+        if start < 0:
+            # Keep a boundary-sized tail in case the marker split
+            # across reads
+            if len(buf) > len(boundary):
+                del buf[:len(buf) - len(boundary)]
+            return None
+        head_end = buf.find(b'\r\n\r\n', start)
+        if head_end < 0:
+            del buf[:start]
+            return None
+        payload_start = head_end + 4
+        length = None
+        headers = bytes(buf[start:head_end]).lower()
+        idx = headers.find(b'content-length:')
+        if idx >= 0:
+            line = headers[idx + len(b'content-length:'):]
+            line = line.split(b'\r\n', 1)[0].strip()
+            try:
+                length = int(line)
+            except ValueError:
+                length = None
+        if length is not None:
+            if len(buf) < payload_start + length:
+                del buf[:start]
+                return None
+            frame = bytes(buf[payload_start:payload_start + length])
+            del buf[:payload_start + length]
+            return frame
+        nxt = buf.find(boundary, payload_start)
+        if nxt < 0:
+            del buf[:start]
+            return None
+        frame = bytes(buf[payload_start:nxt]).strip(b'\r\n')
+        del buf[:nxt]
+        return frame
+
+    @staticmethod
+    def _parse_eoi_frame(buf, scan):
+        """Slice one JPEG out of a raw concatenated stream, or None.
+
+        Anchors on the SOI marker, then resumes the EOI search from
+        where the previous one stopped (scan). Returns (frame, scan).
+        """
+        start = buf.find(b'\xff\xd8')
+        if start < 0:
+            # No frame start in sight; drop boundary noise, but keep a
+            # trailing 0xFF in case the SOI marker split across chunks
+            if buf.endswith(b'\xff'):
+                del buf[:-1]
+            else:
+                del buf[:]
+            return None, 0
+        end = buf.find(b'\xff\xd9', max(start + 2, scan))
+        if end < 0:
+            if start > 0:
+                del buf[:start]
+            # Resume the next search at the tail, one byte back in case
+            # the EOI marker splits across a chunk boundary
+            return None, max(len(buf) - 1, 0)
+        frame = bytes(buf[start:end + 2])
+        del buf[:end + 2]
+        return frame, 0
 
     def _buffer_video_stream(self, stream_url, stream_id):
         """Buffer video frames from a video file stream"""
-        frame_buffer = self.frame_buffers[stream_id]
-        buffer_lock = self.buffer_locks[stream_id]
-
-        while True:
+        stop = self.stop_events[stream_id]
+        next_frame = time.monotonic()
+        while not stop.is_set():
             try:
+                # Idle: release the camera and wait for a consumer
+                if not self._has_demand(stream_id):
+                    if stream_id in self.video_captures:
+                        self.video_captures[stream_id].release()
+                        del self.video_captures[stream_id]
+                        logger.info(f"Video stream {stream_id} idle, released capture")
+                    stop.wait(0.5)
+                    continue
+
                 # Create or get existing video capture
                 if stream_id not in self.video_captures:
                     cap = cv2.VideoCapture(stream_url)
@@ -36,11 +287,21 @@ class StreamProxy:
                         logger.error(f"Failed to open video stream {stream_id}")
                         time.sleep(1)
                         continue
+                    # Keep the driver's internal queue at one frame so a
+                    # source producing faster than we consume can't
+                    # build up lag behind real time (best effort; some
+                    # backends ignore it)
+                    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
                     self.video_captures[stream_id] = cap
                     logger.info(f"Successfully opened video stream {stream_id}")
 
                 cap = self.video_captures[stream_id]
-                ret, frame = cap.read()
+                # grab() advances the stream without decoding; retrieve()
+                # pays the decode only for the frame we actually keep
+                ret = cap.grab()
+                frame = None
+                if ret:
+                    ret, frame = cap.retrieve()
 
                 if not ret:
                     # Video ended, reset capture to loop
@@ -49,21 +310,26 @@ class StreamProxy:
                     continue
 
                 # Convert frame to JPEG
-                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                jpeg_frame = buffer.tobytes()
-
-                with buffer_lock:
-                    try:
-                        frame_buffer.put_nowait(jpeg_frame)
-                    except:
-                        try:
-                            frame_buffer.get_nowait()  # Remove old frame
-                            frame_buffer.put_nowait(jpeg_frame)
-                        except:
-                            pass
-
-                # Control frame rate
-                time.sleep(0.033)  # ~30 FPS
+                if _turbo_jpeg is not None:
+                    jpeg_frame = _turbo_jpeg.encode(frame, quality=85,
+                                                    jpeg_subsample=TJSAMP_420)
+                else:
+                    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                    jpeg_frame = buffer.tobytes()
+
+                self.latest_frames[stream_id] = jpeg_frame
+                with self.frame_available:
+                    self.frame_available.notify_all()
+
+                # Pace against a monotonic deadline so decode + encode
+                # time comes out of the frame budget instead of being
+                # added on top of it
+                next_frame += self.FRAME_INTERVAL
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_frame = time.monotonic()  # fell behind; resync
 
             except Exception as e:
                 logger.error(f"Error in video stream {stream_id}: {str(e)}")
@@ -71,62 +337,151 @@ class StreamProxy:
                 if stream_id in self.video_captures:
                     self.video_captures[stream_id].release()
                     del self.video_captures[stream_id]
-                time.sleep(1)
+                if stop.wait(1):
+                    break
+
+        # Stopped: leave nothing open behind us
+        cap = self.video_captures.pop(stream_id, None)
+        if cap is not None:
+            cap.release()
 
     def get_frame(self, stream_id):
-        """Get the latest frame for a stream"""
-        if stream_id not in self.frame_buffers:
-            return None
+        """Get the latest frame for a stream (consumed once)"""
+        self._last_consumed[stream_id] = time.monotonic()
+        return self.latest_frames.pop(stream_id, None)
 
-        try:
-            with self.buffer_locks[stream_id]:
-                return self.frame_buffers[stream_id].get_nowait()
-        except:
-            return None
+    def keep_alive(self, stream_id):
+        """Mark a stream as wanted without consuming its frame.
+
+        Lets periodic consumers (the mixer) hold a stream's ingest out
+        of the idle pause even while they aren't reading it.
+        """
+        self._last_consumed[stream_id] = time.monotonic()
+
+    def wait_for_frame_event(self, timeout):
+        """Block until some stream buffers a new frame (or timeout).
+
+        Lets consumers wake when data actually arrives instead of
+        polling on a fixed sleep.
+        """
+        with self.frame_available:
+            self.frame_available.wait(timeout)
 
     def ensure_stream_buffer(self, stream_url, stream_id):
         """Ensure a stream buffer exists and is running"""
-        if stream_id not in self.frame_buffers:
-            logger.info(f"Initializing buffer for stream {stream_id}")
+        existing = self.stream_threads.get(stream_id)
+        if existing is not None and existing.is_alive():
+            return
 
-            self.frame_buffers[stream_id] = Queue(maxsize=2)
-            self.buffer_locks[stream_id] = threading.Lock()
+        logger.info(f"Initializing buffer for stream {stream_id}")
+        if existing is not None:
+            # The previous thread exited (stopped or crashed); signal it
+            # and wait briefly so its camera handle is released before a
+            # replacement opens the source again
+            self.stop_events[stream_id].set()
+            existing.join(timeout=2)
+            cap = self.video_captures.pop(stream_id, None)
+            if cap is not None:
+                cap.release()
 
-            # Stop existing thread if any
-            if stream_id in self.stream_threads and self.stream_threads[stream_id].is_alive():
-                if stream_id in self.video_captures:
-                    self.video_captures[stream_id].release()
-                    del self.video_captures[stream_id]
-                self.stream_threads[stream_id] = None
+        # Seed demand so the fresh thread doesn't idle before the
+        # first consumer arrives
+        self._last_consumed[stream_id] = time.monotonic()
+        self.stop_events[stream_id] = threading.Event()
 
-            self.stream_threads[stream_id] = threading.Thread(
-                target=self._buffer_video_stream,
-                args=(stream_url, stream_id),
-                daemon=True
-            )
-            self.stream_threads[stream_id].start()
-            logger.info(f"Started buffer thread for stream {stream_id}")
+        # MJPEG sources get the passthrough reader; everything else
+        # (video files, RTSP) still goes through VideoCapture. The
+        # URL heuristic avoids a probe for obvious cases, the HEAD
+        # probe catches MJPEG servers with nondescript URLs
+        is_mjpeg = (self._looks_like_mjpeg(stream_url)
+                    or self._probe_is_mjpeg(stream_url))
+        target = (self._buffer_mjpeg_stream if is_mjpeg
+                  else self._buffer_video_stream)
+        self.stream_threads[stream_id] = threading.Thread(
+            target=target,
+            args=(stream_url, stream_id),
+            daemon=True
+        )
+        self.stream_threads[stream_id].start()
+        logger.info(f"Started buffer thread for stream {stream_id}")
 
     def proxy_stream(self, stream_url, stream_id=None):
-        """Proxy a stream with buffering"""
+        """Proxy a stream with buffering.
+
+        Accepts an optional ?w=<pixels> query parameter: thumbnail
+        viewers then get frames downscaled (and re-encoded) to that
+        width instead of paying full-resolution bandwidth.
+        """
         if stream_id is not None:
             self.ensure_stream_buffer(stream_url, stream_id)
+            width = request.args.get('w', type=int)
+            if width is not None:
+                if width <= 0:
+                    width = None
+                else:
+                    # Snap to the nearest allowed width so arbitrary
+                    # client values can't each pin a cache entry
+                    width = min(self.ALLOWED_WIDTHS,
+                                key=lambda w: abs(w - width))
             return Response(
-                self._generate_from_buffer(stream_id),
+                self._generate_from_buffer(stream_id, width=width),
                 mimetype='multipart/x-mixed-replace; boundary=frame'
             )
         return Response(status=400)
 
-    def _generate_from_buffer(self, stream_id):
+    def _resized_frame(self, stream_id, frame, width):
+        """Downscale a JPEG for thumbnail viewers, cached per width.
+
+        Keyed on the source bytes object so concurrent viewers at the
+        same width share one decode + resize + encode per frame.
+        Returns the original frame when it is already narrow enough or
+        the resize fails.
+        """
+        key = (stream_id, width)
+        cached = self._resized_cache.get(key)
+        if cached is not None and cached[0] is frame:
+            return cached[1]
+        try:
+            nparr = np.frombuffer(frame, np.uint8)
+            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            if img is None or img.shape[1] <= width:
+                # Cache the no-op decision too, so already-narrow
+                # sources don't pay a decode per frame per viewer
+                self._resized_cache[key] = (frame, frame)
+                return frame
+            height = max(1, int(img.shape[0] * width / img.shape[1]))
+            img = cv2.resize(img, (width, height),
+                             interpolation=cv2.INTER_AREA)
+            if _turbo_jpeg is not None:
+                resized = _turbo_jpeg.encode(img, quality=85,
+                                             jpeg_subsample=TJSAMP_420)
+            else:
+                _, buffer = cv2.imencode('.jpg', img,
+                                         [cv2.IMWRITE_JPEG_QUALITY, 85])
+                resized = buffer.tobytes()
+        except Exception as e:
+            logger.error("Error resizing frame for stream %d: %s",
+                         stream_id, e)
+            return frame
+        self._resized_cache[key] = (frame, resized)
+        return resized
+
+    def _generate_from_buffer(self, stream_id, width=None):
         """Generate frames from the buffer"""
         logger.info(f"Starting frame generation from buffer for stream {stream_id}")
         while True:
             frame = self.get_frame(stream_id)
             if frame is not None:
-                yield (b'--frame\r\n'
-                      b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+                if width is not None:
+                    frame = self._resized_frame(stream_id, frame, width)
+                yield _FRAME_HEADER
+                yield frame
+                yield _FRAME_TRAILER
             else:
-                time.sleep(0.033)  # ~30 FPS
+                # Wake when a buffer thread stores a frame instead of
+                # polling on a fixed sleep; the timeout keeps the
+                # generator responsive if the source stalls
+                self.wait_for_frame_event(1.0)
 
     def __del__(self):
         """Cleanup video captures on deletion"""